@@ -16,10 +16,33 @@ Expected parameters:
 import allsky_shared as s
 import os
 import ephem
+import sys
+import io
+import json
+import time
+import fcntl
 import datetime
+import threading
+import tempfile
+import subprocess
 import cv2
 import numpy as np
-from math import degrees
+from math import degrees, radians, sin, cos, floor, ceil
+from collections import deque
+
+def _tmpPath(name):
+    # allsky module runs are separate processes, state kept between images goes to allsky tmp
+    return os.path.join(os.environ.get("ALLSKY_TMP", tempfile.gettempdir()), name)
+
+def _writeAside(path, data):
+    # written aside and renamed, so a concurrent run never reads a partial file
+    tmp = path + ".{0}.tmp".format(os.getpid())
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        pass
 
 metaData = {
     "name": "Light Graph",
@@ -54,6 +77,7 @@ metaData = {
         "elev_vert_pos": 10,
         "elev_width": 300,
         "elev_height": 100,
+        "prerender": "false",
         "debug": "False"
     },
     "argumentdetails": {
@@ -277,6 +301,14 @@ metaData = {
                 "step": 1
             }
         },
+        "prerender": {
+            "required": "false",
+            "description": "Prepare next overlay in background",
+            "help": "The overlay for the next image is drawn while the camera is exposing, by a helper process that stays in memory (about 60 MB). Shortens the time per image, but uses more CPU in total: not worth it on slow boards",
+            "type": {
+                "fieldtype": "checkbox"
+            }
+        },
        "debug": {
             "required": "false",
             "description": "Enable debug mode",
@@ -299,12 +331,21 @@ class lGraph():
     graph_X = graph_Y = graph_width = graph_height = 0
     elev_X = elev_Y = elev_width = elev_height = 0
     npoints = res = 0
-    startTime = finishTime = nowTime = datetime.datetime.now()
-    startTimeUTC = finishTimeUTC = nowTimeUTC = datetime.datetime.utcnow()
+    startTime = finishTime = nowTime = None
+    startTimeUTC = finishTimeUTC = nowTimeUTC = None
     midnight = noon = None
     location = None
     timeArray = []
     sunPath = moonPath = []
+    pathCache = {} # elevation samples kept between frames, per location and resolution (also on disk)
+    pathLock = threading.Lock()
+    EPOCH = datetime.datetime(1970, 1, 1)
+    GRID_STEP = 10800 # seconds between solar altitude samples when looking for events
+    REFINE_TOL = 10.0 # seconds, precision of the refined events (a pixel is about 108 s at 800 px)
+    REFINE_MAX = 20
+    HORIZONS = ((-18.0, ("DawnAstro", "DuskAstro")), (-12.0, ("DawnNauti", "DuskNauti")),
+                (-6.0, ("DawnCivil", "DuskCivil")), (0.0, ("Sunrise", "Sunset")))
+    TRANSITS = ("Noon", "Midnight")
 
     def _readColor(self, input):
         return tuple(int(item) for item in input.split(' '))
@@ -312,6 +353,13 @@ class lGraph():
     def _scaleColor(self, val1, val2, fraction):
         return tuple(sum(x) * fraction for x in zip(val1,val2))
 
+    def _latLon(self, params, name):
+        # degrees as a number, or an allsky setting string ("51.5N"), from params or allsky settings
+        value = params[name] if name in params else s.getSetting(name)
+        if isinstance(value, (int, float)):
+            return float(value)
+        return s.convertLatLon(value)
+
     def get_params(self, debug, params):
       
         self.border_color = self._readColor(params["border_color"])
@@ -324,17 +372,17 @@ class lGraph():
         self.civil2nauti_color = self._scaleColor(self.light_color, self.dark_color, 0.50)
         self.nauti2astro_color = self._scaleColor(self.light_color, self.dark_color, 0.25)
 
-        self.latitude = s.convertLatLon(s.getSetting("latitude"))
-        self.longitude = s.convertLatLon(s.getSetting("longitude"))
+        self.latitude = self._latLon(params, "latitude")
+        self.longitude = self._latLon(params, "longitude")
 
         if params["draw_elev"] == True:
             self.elev_color = self._readColor(params["elev_color"])
             self.sun_color = self._readColor(params["sun_color"])
             self.moon_color = self._readColor(params["moon_color"])
                 
-    def set_size(self, debug, params):
-        self.image_width = s.image.shape[1]
-        self.image_height = s.image.shape[0]
+    def set_size(self, debug, params, image):
+        self.image_width = image.shape[1]
+        self.image_height = image.shape[0]
         self.graph_width = int(params["width"])
         self.graph_height = int(params["height"])
         self.graph_X = int(params["horiz_pos"])
@@ -404,139 +452,92 @@ class lGraph():
 
         return res
 
-    def calculations(self, debug, params):
+    def _sunAltHa(self, sun, t):
+        # solar altitude (degrees, upper limb as ephem risings/settings) and sine of the hour angle at t (UTC)
+        self.location.date = ephem.Date(t)
+        sun.compute(self.location)
+        return (degrees(sun.alt + sun.radius), sin(sun.ha))
+
+    def _refine(self, sun, k, level, a, fa, b, fb):
+        # Illinois regula falsi on sample k (see _sunAltHa) minus level, root bracketed by a and b
+        side = 0
+        tx = a + (b - a) * (fa / (fa - fb))
+        for n in range(self.REFINE_MAX):
+            fx = self._sunAltHa(sun, tx)[k] - level
+            if fx == 0:
+                break
+            if (fx < 0) == (fa < 0):
+                a, fa = tx, fx
+                if side == 1:
+                    fb = fb / 2.0
+                side = 1
+            else:
+                b, fb = tx, fx
+                if side == -1:
+                    fa = fa / 2.0
+                side = -1
+            t = a + (b - a) * (fa / (fa - fb))
+            done = abs((t - tx).total_seconds()) < self.REFINE_TOL
+            tx = t
+            if done:
+                break
+        return tx
+
+    def _sunEvents(self, t1, t2):
+        # find every horizon crossing and transit between t1 and t2 (UTC) from a single
+        # grid of solar positions, each bracket refined to REFINE_TOL
+        step = datetime.timedelta(seconds=self.GRID_STEP)
+        sun = ephem.Sun()
+        times = [t1]
+        while times[-1] < t2:
+            times.append(times[-1] + step)
+        samples = [self._sunAltHa(sun, t) for t in times]
+
+        # transits and anti-transits, where the hour angle changes sign
+        events = []
+        points = [(times[i], samples[i][0]) for i in range(len(times))]
+        for i in range(len(times) - 1):
+            f1 = samples[i][1]
+            f2 = samples[i + 1][1]
+            if (f1 < 0) == (f2 < 0):
+                continue
+            tx = self._refine(sun, 1, 0.0, times[i], f1, times[i + 1], f2)
+            # the altitude extremes are there, so they split the brackets below and dips
+            # shorter than the grid step are not lost
+            points = points + [(tx, self._sunAltHa(sun, tx)[0])]
+            if t1 <= tx <= t2:
+                events = events + [(tx, self.TRANSITS[0] if f2 > f1 else self.TRANSITS[1])]
+        points.sort()
+
+        # horizon crossings, on altitude
+        for i in range(len(points) - 1):
+            for level, (up, down) in self.HORIZONS:
+                f1 = points[i][1] - level
+                f2 = points[i + 1][1] - level
+                if (f1 < 0) == (f2 < 0):
+                    continue
+                tx = self._refine(sun, 0, level, points[i][0], f1, points[i + 1][0], f2)
+                if t1 <= tx <= t2:
+                    events = events + [(tx, up if f2 > f1 else down)]
+
+        return events
+
+    def _setLocation(self):
         self.location = ephem.Observer()
         self.location.lat = self._convertLatLon(self.latitude)
         self.location.lon = self._convertLatLon(self.longitude)
         self.location.date = ephem.Date(self.nowTimeUTC)
 
-        ss = ephem.Sun()
-
-        # store in an array all next risings and settings, and transits
-        self.location.horizon ='-18:0'
-        try:
-            raise_astro1 = self.location.next_rising(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(raise_astro1, "DawnAstro")]
-        except:
-            pass
-        try:
-            set_astro1 = self.location.next_setting(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(set_astro1, "DuskAstro")]
-        except:
-            pass
-        self.location.horizon ='-12:0'
-        try:
-            raise_nauti1 = self.location.next_rising(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(raise_nauti1, "DawnNauti")]
-        except:
-            pass
-        try:
-            set_nauti1 = self.location.next_setting(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(set_nauti1, "DuskNauti")]
-        except:
-            pass
-        self.location.horizon ='-6:0'
-        try:
-            raise_civil1 = self.location.next_rising(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(raise_civil1, "DawnCivil")]
-        except:
-            pass
-        try:
-            set_civil1 = self.location.next_setting(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(set_civil1, "DuskCivil")]
-        except:
-            pass
-        self.location.horizon ='0:0'
-        try:
-            raise1 = self.location.next_rising(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(raise1, "Sunrise")]
-        except:
-            pass
-        try:
-            set1 = self.location.next_setting(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(set1, "Sunset")]
-        except:
-            pass
-
-        try:
-            transit1 = self.location.next_transit(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(transit1, "Noon")]
-        except:
-            pass
-        try:
-            anti_transit1 = self.location.next_antitransit(ephem.Sun()).datetime()
-            self.timeArray = self.timeArray + [(anti_transit1, "Midnight")]
-        except:
-            pass
-        
-        # of centered, add all previous risings and settings and transits
-        if params["now_point"] == "Center":
-            self.location.horizon ='-18:0'
-            try:
-                raise_astro2 = self.location.previous_rising(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(raise_astro2, "DawnAstro")]
-            except:
-                pass
-            try:
-                set_astro2 = self.location.previous_setting(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(set_astro2, "DuskAstro")]
-            except:
-                pass
-            self.location.horizon ='-12:0'
-            try:
-                raise_nauti2 = self.location.previous_rising(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(raise_nauti2, "DawnNauti")]
-            except:
-                pass
-            try:
-                set_nauti2 = self.location.previous_setting(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(set_nauti2, "DuskNauti")]
-            except:
-                pass
-            self.location.horizon ='-6:0'
-            try:
-                raise_civil2 = self.location.previous_rising(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(raise_civil2, "DawnCivil")]
-            except:
-                pass
-            try:
-                set_civil2 = self.location.previous_setting(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(set_civil2, "DuskCivil")]
-            except:
-                pass
-            self.location.horizon ='0:0'
-            try:
-                raise2 = self.location.previous_rising(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(raise2, "Sunrise")]
-            except:
-                pass
-            try:
-                set2 = self.location.previous_setting(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(set2, "Sunset")]
-            except:
-                pass
+    def calculations(self, debug, params):
+        self._setLocation()
 
-            try:
-                transit2 = self.location.previous_transit(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(transit2, "Noon")]
-            except:
-                pass
-            try:
-                anti_transit2 = self.location.previous_antitransit(ephem.Sun()).datetime()
-                self.timeArray = self.timeArray + [(anti_transit2, "Midnight")]
-            except:
-                pass
+        # all twilight crossings and transits in one pass over a coarse altitude grid
+        self.timeArray = self._sunEvents(self.startTimeUTC, self.finishTimeUTC)
+        self.location.date = ephem.Date(self.nowTimeUTC)
 
         # sort all events
         self.timeArray.sort()
 
-        # filter out events before start time or after end time
-        while (self.timeArray[0])[0] < self.startTimeUTC:
-            self.timeArray = self.timeArray[1:]
-
-        while (self.timeArray[-1])[0] > self.finishTimeUTC:
-            self.timeArray = self.timeArray[:-1]
-
         # add start and end time events
         self.timeArray = [(self.startTimeUTC, "Start")] + self.timeArray + [(self.finishTimeUTC, "Finish")]
 
@@ -564,25 +565,80 @@ class lGraph():
                 self.midnight = moment
                 self.timeArray.remove(moment)     
 
+    def _altToY(self, alt):
+        return int(alt / 90.0 * self.elev_height / 2.0)
+
     def calSunMoon(self, params):
         k = 3 # k is the precission for moon-solar plot in pixels
         self.npoints = int(self.elev_width / k) + 1
         self.res = self.elev_width / self.npoints
         delta_t = 24.0 * 3600.0 / self.npoints
+
+        # samples are aligned to absolute times (multiples of delta_t since the epoch) and kept
+        # between frames (in allsky tmp, as every image is a new process), so only the ones
+        # entering the window need to be computed
+        t0 = (self.startTimeUTC - self.EPOCH).total_seconds()
+        first = int(floor(t0 / delta_t))
+        last = int(ceil((t0 + 24.0 * 3600.0) / delta_t))
+        key = (self.latitude, self.longitude, self.npoints, params["now_point"])
         sun = ephem.Sun()
         moon = ephem.Moon()
-        for x in range(self.npoints + 1):
-            xt = self.startTimeUTC + datetime.timedelta(seconds=x * delta_t)
-            self.location.date = ephem.Date(xt)
-            sun.compute(self.location)
-            self.sunPath = self.sunPath + [(x * self.res, int(degrees(sun.alt) / 90.0 * self.elev_height / 2.0))]
-            moon.compute(self.location)
-            self.moonPath = self.moonPath + [(x * self.res, int(degrees(moon.alt) / 90.0 * self.elev_height / 2.0))]
+        with self.pathLock: # the cache is shared by all renderers in the process
+            ring = self.pathCache.get(key)
+            if ring is None:
+                ring = self._loadPath(key)
+            if not ring or ring[0][0] > first or ring[-1][0] < first - 1:
+                ring = deque()
+            self.pathCache[key] = ring
+            changed = False
+            while ring and ring[0][0] < first:
+                ring.popleft()
+                changed = True
+
+            n = ring[-1][0] + 1 if ring else first
+            for x in range(n, last + 1):
+                self.location.date = ephem.Date(self.EPOCH + datetime.timedelta(seconds=x * delta_t))
+                sun.compute(self.location)
+                moon.compute(self.location)
+                ring.append((x, degrees(sun.alt), degrees(moon.alt)))
+                changed = True
+            if changed:
+                self._savePath(key, ring)
+            samples = [r for r in ring if r[0] <= last]
+
+        # pixel paths, first and last segments clipped to the chart edges
+        xs = [(x * delta_t - t0) / delta_t * self.res for x, sa, ma in samples]
+        self.sunPath = self._clipPath(xs, [sa for x, sa, ma in samples])
+        self.moonPath = self._clipPath(xs, [ma for x, sa, ma in samples])
+
+    def _pathFile(self, key):
+        return _tmpPath("lightgraph_path_{0:.4f}_{1:.4f}_{2}_{3}.npy".format(*key))
+
+    def _loadPath(self, key):
+        try:
+            data = np.load(self._pathFile(key))
+        except (OSError, ValueError):
+            return deque()
+        return deque((int(x), sa, ma) for x, sa, ma in data)
+
+    def _savePath(self, key, ring):
+        buf = io.BytesIO()
+        np.save(buf, np.array(ring, dtype=np.float64).reshape(-1, 3))
+        _writeAside(self._pathFile(key), buf.getvalue())
+
+    def _clipPath(self, xs, alts):
+        path = [(xs[i], alts[i]) for i in range(len(xs))]
+        for i, edge in ((0, 0.0), (-1, float(self.elev_width))):
+            j = 1 if i == 0 else -2
+            (x1, a1), (x2, a2) = path[i], path[j]
+            if x1 != edge and x2 != x1:
+                path[i] = (edge, a1 + (a2 - a1) * (edge - x1) / (x2 - x1))
+        return [(x, self._altToY(a)) for x, a in path]
 
     def _azMidDarkness(self, dt1, dt2):
         tdelta = (dt2 - dt1).total_seconds()
         tmid = dt1 + datetime.timedelta(seconds=tdelta/2)
-        loc = self.location
+        loc = self.location.copy()
         loc.date = ephem.Date(tmid.strftime("%Y/%m/%d %H:%M:%S"))
         sun = ephem.Sun()
         sun.compute(loc)
@@ -600,65 +656,128 @@ class lGraph():
 
         return drk
 
-    def draw (self, params):
+    def _nativeColor(self, color, image):
+        # map a BGR 8 bit color to the channels and depth of image
+        channels = 1 if image.ndim == 2 else image.shape[2]
+        if image.dtype.kind in "ui":
+            scale = np.iinfo(image.dtype).max / 255.0
+        else:
+            scale = 1.0 / 255.0
+        if channels == 1:
+            res = (0.114 * color[0] + 0.587 * color[1] + 0.299 * color[2],)
+        else:
+            res = tuple(color[:3]) + (255,) * (channels - 3)
+        return tuple(c * scale for c in res)
+
+    def _nativeColors(self, image, params):
+        res = {}
+        names = ["border", "light", "dark", "text", "day2civil", "civil2nauti", "nauti2astro"]
+        if params["draw_elev"] == True:
+            names = names + ["elev", "sun", "moon"]
+        for name in names:
+            res[name] = self._nativeColor(getattr(self, name + "_color"), image)
+        return res
+
+    def _putText(self, image, text, org, font, scale, color):
+        # putText only handles 8 bit images on some opencv builds, other depths get the text
+        # rasterized on a small 8 bit mask and blended on the text area only
+        if image.dtype == np.uint8:
+            cv2.putText(image, text, org, font, scale, color, 1, cv2.LINE_AA)
+            return
+        (w, h), base = cv2.getTextSize(text, font, scale, 1)
+        x1 = max(org[0], 0)
+        y1 = max(org[1] - h - 1, 0)
+        x2 = min(org[0] + w + 1, image.shape[1])
+        y2 = min(org[1] + base + 1, image.shape[0])
+        if x2 <= x1 or y2 <= y1:
+            return
+        mask = np.zeros((y2 - y1, x2 - x1), np.uint8)
+        cv2.putText(mask, text, (org[0] - x1, org[1] - y1), font, scale, 255, 1, cv2.LINE_AA)
+        m = mask.astype(np.float32) / 255.0
+        roi = image[y1:y2, x1:x2]
+        if roi.ndim == 3:
+            m = m[:, :, np.newaxis]
+        c = np.array(color[:1 if roi.ndim == 2 else roi.shape[2]], np.float32)
+        res = roi * (1.0 - m) + c * m
+        if image.dtype.kind in "ui":
+            res = np.clip(np.rint(res), 0, np.iinfo(image.dtype).max)
+        roi[:] = res.astype(image.dtype)
+
+    def _hourTicks(self, x0, width, count):
+        # x and hour of the whole hours along a 24 h axis width pixels wide starting at x0
+        firstIntHourTime = self.startTime.replace(second=0, minute=0, microsecond=0) # everything is calculated in UTC, but this is local
+        startingX = -(self.startTime - firstIntHourTime).total_seconds() / 3600.0 / 24.0 * width + x0
+        hourdeltaPx = width / 24.0
+        return [(int(startingX + i * hourdeltaPx), (firstIntHourTime.hour + i) % 24) for i in range(count)]
+
+    def signature(self, params):
+        # every position draw() takes from the time, equal signatures (same params) draw the same
+        fills = [(self.timeArray[i][2], self._azMidDarkness(self.timeArray[i][0], self.timeArray[i + 1][0])) for i in range(len(self.timeArray) - 1)]
+        res = [fills, self.timeArray[-1][2], self.noon and self.noon[2], self.midnight and self.midnight[2],
+            self._hourTicks(self.graph_X, self.graph_width, 26)]
+        if params["draw_elev"] == True:
+            res = res + [self._hourTicks(self.elev_X, self.elev_width, 25),
+                [(int(x), y) for x, y in self.sunPath], [(int(x), y) for x, y in self.moonPath]]
+        return json.dumps(res)
+
+    def draw (self, params, image):
+        # returns the composited image, image itself is drawn on when opaque
         alpha = float(params["alpha"])
         textSize = float(params["hour_txt_size"])
         
-        canvas = s.image
         if alpha < 1.0:
-            canvas = s.image.copy() # if transparency, work on a copy
+            canvas = image.copy() # if transparency, work on a copy
         else:
-            canvas = s.image
+            canvas = image
+
+        # colors in the image native channels and depth, so no conversion of the frame is needed
+        col = self._nativeColors(canvas, params)
 
         # dark areas
         for i in range(len(self.timeArray)-1):
             # print (self._timeArray[i][0].strftime("%Y-%m-%d %H:%M:%S"), " to ",self._timeArray[i+1][0].strftime("%Y-%m-%d %H:%M:%S"), "(", self._timeArray[i][1], " to ",self._timeArray[i+1][1])
             drk = self._azMidDarkness(self.timeArray[i][0], self.timeArray[i + 1][0])
             if drk == 0:
-                col = self.dark_color
+                fill = col["dark"]
             elif drk == 1:
-                col = self.nauti2astro_color
+                fill = col["nauti2astro"]
             elif drk == 2:
-                col = self.civil2nauti_color
+                fill = col["civil2nauti"]
             elif drk == 3:
-                col = self.day2civil_color
+                fill = col["day2civil"]
             else:
-                col = self.light_color
+                fill = col["light"]
 
             cv2.rectangle(img=canvas, \
                 pt1=(self.graph_X + self.timeArray[i][2], self.graph_Y), \
                 pt2=(self.graph_X + self.timeArray[i + 1][2], self.graph_Y + self.graph_height), \
-                color=col, thickness=cv2.FILLED)
+                color=fill, thickness=cv2.FILLED)
 
         # transits
         if self.noon:
             cv2.line(img=canvas, pt1=(self.graph_X + self.noon[2], self.graph_Y), \
-                pt2=(self.graph_X + self.noon[2], self.graph_Y + self.graph_height), color=self.dark_color)
+                pt2=(self.graph_X + self.noon[2], self.graph_Y + self.graph_height), color=col["dark"])
 
         if self.midnight:
             cv2.line(img=canvas, pt1=(self.graph_X + self.midnight[2], self.graph_Y), \
-                pt2=(self.graph_X + self.midnight[2], self.graph_Y + self.graph_height), color=self.light_color)
+                pt2=(self.graph_X + self.midnight[2], self.graph_Y + self.graph_height), color=col["light"])
 
         # box
         cv2.rectangle(img=canvas, pt1=(self.graph_X, self.graph_Y), \
             pt2=(self.graph_X + self.graph_width, self.graph_Y + self.graph_height), \
-            thickness=2, color=self.border_color)    
+            thickness=2, color=col["border"])    
 
         # hour ticks
         if params["hour_ticks"] == True:
             tickSize = int(self.graph_height / 5)
-            firstIntHourTime = self.startTime.replace(second=0, minute=0, microsecond=0) # everything is calculated in UTC, but this is local
-            startingX = -(self.startTime - firstIntHourTime).total_seconds() / 3600.0 / 24.0 * self.graph_width + self.graph_X
             hourdeltaPx = self.graph_width / 24.0
 
             yy = self.graph_Y
             font = cv2.FONT_HERSHEY_SIMPLEX
-            onlyHour = firstIntHourTime.hour
             skipHour = False               
-            for i in range(26):
-                xPos = int(startingX + i * hourdeltaPx)
+            for xPos, onlyHour in self._hourTicks(self.graph_X, self.graph_width, 26):
                 if xPos > self.graph_X and xPos < self.graph_X + self.graph_width:
-                    cv2.line(img=canvas, pt1=(xPos, self.graph_Y), pt2=(xPos, self.graph_Y - tickSize), thickness=2, color=self.border_color)
+                    cv2.line(img=canvas, pt1=(xPos, self.graph_Y), pt2=(xPos, self.graph_Y - tickSize), thickness=2, color=col["border"])
                     if params["hour_nums"] == True:
                         textSz = cv2.getTextSize(str(onlyHour).zfill(2), font, textSize, 1)[0]
                         textX = xPos - int(textSz[0] / 2.0)
@@ -667,10 +786,7 @@ class lGraph():
                         elif textSz[0] > hourdeltaPx:
                             skipHour = True
                         if not skipHour:
-                            cv2.putText(canvas, str(onlyHour).zfill(2), (textX, self.graph_Y - tickSize - 1), font, textSize, self.text_color, 1, cv2.LINE_AA)
-                onlyHour = onlyHour + 1
-                if onlyHour == 24:
-                    onlyHour = 0
+                            self._putText(canvas, str(onlyHour).zfill(2), (textX, self.graph_Y - tickSize - 1), font, textSize, col["text"])
 
         # now mark
         if params["now_point"] == "Center":
@@ -679,128 +795,498 @@ class lGraph():
             startingX = self.graph_X
         
         tri = np.array([[startingX, self.graph_Y + 8], [startingX - 5, self.graph_Y], [startingX + 5, self.graph_Y]])
-        cv2.fillPoly(img=canvas, pts=[tri], color=self.border_color)
+        cv2.fillPoly(img=canvas, pts=[tri], color=col["border"])
         tri = np.array([[startingX, self.graph_Y + self.graph_height - 8], [startingX - 5, self.graph_Y + self.graph_height], [startingX + 5, self.graph_Y + self.graph_height]])
-        cv2.fillPoly(img=canvas, pts=[tri], color=self.border_color)
+        cv2.fillPoly(img=canvas, pts=[tri], color=col["border"])
 
         #elev chart
         if params["draw_elev"] == True:
             # box
             cv2.rectangle(img=canvas, pt1=(self.elev_X, self.elev_Y), \
                 pt2=(self.elev_X + self.elev_width, self.elev_Y + self.elev_height), \
-                thickness=1, color=self.elev_color)
+                thickness=1, color=col["elev"])
             cv2.line(img=canvas, pt1=(self.elev_X, self.elev_Y + int(self.elev_height / 2)), \
-                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2)), thickness=2, color=self.elev_color)
+                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2)), thickness=2, color=col["elev"])
             TROPIC = 23.5
             POLAR = 66.5
             cv2.line(img=canvas, pt1=(self.elev_X, self.elev_Y + int(self.elev_height / 2 - POLAR * self.elev_height / 180.0)), \
-                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 - POLAR * self.elev_height / 180.0)), thickness=1, color=self.elev_color)
+                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 - POLAR * self.elev_height / 180.0)), thickness=1, color=col["elev"])
             cv2.line(img=canvas, pt1=(self.elev_X, self.elev_Y + int(self.elev_height / 2 - TROPIC * self.elev_height / 180.0)), \
-                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 - TROPIC * self.elev_height / 180.0)), thickness=1, color=self.elev_color)
+                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 - TROPIC * self.elev_height / 180.0)), thickness=1, color=col["elev"])
             cv2.line(img=canvas, pt1=(self.elev_X, self.elev_Y + int(self.elev_height / 2 + POLAR * self.elev_height / 180.0)), \
-                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 + POLAR * self.elev_height / 180.0)), thickness=1, color=self.elev_color)
+                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 + POLAR * self.elev_height / 180.0)), thickness=1, color=col["elev"])
             cv2.line(img=canvas, pt1=(self.elev_X, self.elev_Y + int(self.elev_height / 2 + TROPIC * self.elev_height / 180.0)), \
-                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 + TROPIC * self.elev_height / 180.0)), thickness=1, color=self.elev_color)
+                                pt2=(self.elev_X + self.elev_width, self.elev_Y + int(self.elev_height / 2 + TROPIC * self.elev_height / 180.0)), thickness=1, color=col["elev"])
             
             # hours
-            startingX = (firstIntHourTime - self.startTime).total_seconds() / 3600.0 / 24.0 * self.elev_width + self.elev_X
-            hourdeltaPx = self.elev_width / 24.0
-            yy = self.elev_Y
-            onlyHour = firstIntHourTime.hour               
-            for i in range(25):
-                xPos = int(startingX + i * hourdeltaPx)
+            for xPos, onlyHour in self._hourTicks(self.elev_X, self.elev_width, 25):
                 if xPos > self.elev_X and xPos < self.elev_X + self.elev_width:
-                    cv2.line(img=canvas, pt1=(xPos, self.elev_Y), pt2=(xPos, self.elev_Y + self.elev_height), thickness=1, color=self.elev_color)
-                onlyHour = onlyHour + 1
-                if onlyHour == 24:
-                    onlyHour = 0
+                    cv2.line(img=canvas, pt1=(xPos, self.elev_Y), pt2=(xPos, self.elev_Y + self.elev_height), thickness=1, color=col["elev"])
 
             # mark
             if params["now_point"] == "Center":
                 startingX = self.elev_X+ int(self.elev_width / 2)
             else:
                 startingX = self.elev_X 
-            cv2.line(img=canvas, pt1=(startingX, self.elev_Y), pt2=(startingX, self.elev_Y + self.elev_height), thickness=2, color=self.elev_color)
+            cv2.line(img=canvas, pt1=(startingX, self.elev_Y), pt2=(startingX, self.elev_Y + self.elev_height), thickness=2, color=col["elev"])
 
             # paths
             for i in range(len(self.sunPath) - 1):
                 cv2.line(img=canvas, \
-                    pt1=(self.elev_X + int(i * self.res), \
+                    pt1=(self.elev_X + int(self.sunPath[i][0]), \
                         self.elev_Y + int(self.elev_height / 2.0) - self.sunPath[i][1]), \
-                    pt2=(self.elev_X + int((i + 1) * self.res), \
+                    pt2=(self.elev_X + int(self.sunPath[i + 1][0]), \
                         self.elev_Y + int(self.elev_height / 2.0) - self.sunPath[i + 1][1]), \
-                    thickness=1, color=self.sun_color)
+                    thickness=1, color=col["sun"])
                 cv2.line(img=canvas, \
-                    pt1=(self.elev_X + int(i * self.res), \
+                    pt1=(self.elev_X + int(self.moonPath[i][0]), \
                         self.elev_Y + int(self.elev_height / 2.0) - self.moonPath[i][1]), \
-                    pt2=(self.elev_X + int((i + 1) * self.res), \
+                    pt2=(self.elev_X + int(self.moonPath[i + 1][0]), \
                         self.elev_Y + int(self.elev_height / 2.0) - self.moonPath[i + 1][1]), \
-                    thickness=1, color=self.moon_color)
+                    thickness=1, color=col["moon"])
 
         if alpha < 1.0:
-            tmpcanv = cv2.addWeighted(canvas, alpha, s.image, 1 - alpha, 0)
-            s.image = tmpcanv
-        else:
-            s.image = canvas
+            canvas = cv2.addWeighted(canvas, alpha, image, 1 - alpha, 0).reshape(image.shape) # keeps (h, w, 1)
+        return canvas
+
+    def _regions(self, params, image):
+        # areas drawn by draw(), with room for the hour ticks, numbers and now marks:
+        # [(y1, y2, x1, x2), ...], overlapping ones merged
+        textW, textH = cv2.getTextSize("00", cv2.FONT_HERSHEY_SIMPLEX, float(params["hour_txt_size"]), 1)[0]
+        above = int(self.graph_height / 5) + textH + 4
+        side = int(textW / 2) + 8
+        res = [[self.graph_Y - above, self.graph_Y + self.graph_height + 3, self.graph_X - side, self.graph_X + self.graph_width + side]]
+        if params["draw_elev"] == True:
+            elev = [self.elev_Y - 2, self.elev_Y + self.elev_height + 3, self.elev_X - 2, self.elev_X + self.elev_width + 3]
+            r = res[0]
+            if elev[0] < r[1] and r[0] < elev[1] and elev[2] < r[3] and r[2] < elev[3]:
+                res = [[min(r[0], elev[0]), max(r[1], elev[1]), min(r[2], elev[2]), max(r[3], elev[3])]]
+            else:
+                res = res + [elev]
+        h, w = image.shape[:2]
+        return [(max(y1, 0), min(y2, h), max(x1, 0), min(x2, w)) for y1, y2, x1, x2 in res]
+
+    def layer(self, params, image):
+        # overlay rasterized on black and on white, giving its color and coverage per pixel,
+        # only over the graph areas: [(y1, x1, color, coverage), ...]
+        top = np.iinfo(image.dtype).max if image.dtype.kind in "ui" else 1.0
+        opaque = dict(params, alpha=1.0)
+        alpha = float(params["alpha"])
+        origin = (self.graph_X, self.graph_Y, self.elev_X, self.elev_Y)
+        res = []
+        for y1, y2, x1, x2 in self._regions(params, image):
+            # draw with the region moved to the origin of a canvas of its size
+            self.graph_X, self.graph_Y, self.elev_X, self.elev_Y = origin[0] - x1, origin[1] - y1, origin[2] - x1, origin[3] - y1
+            shape = (y2 - y1, x2 - x1) + image.shape[2:]
+            try:
+                black = self.draw(opaque, np.zeros(shape, image.dtype)).astype(np.float32)
+                white = self.draw(opaque, np.full(shape, top, image.dtype)).astype(np.float32)
+            finally:
+                self.graph_X, self.graph_Y, self.elev_X, self.elev_Y = origin
+            coverage = alpha * (1.0 - (white - black) / top)
+            res.append((y1, x1, alpha * black, coverage))
+        return res
 
     def exportData(self):
         # this is temporary until allsky exports all relevant datetimes
         sun = ephem.Sun()
+        loc = self.location.copy()
+        loc.horizon = 0
+        loc.date = ephem.Date(self.nowTimeUTC)
 
-        t = datetime.datetime.utcnow()
-        self.location.horizon = 0
-
-        self.location.date = ephem.Date(t)
-
-        sun.compute(self.location)
+        sun.compute(loc)
         sun_alt = "{:.3f}".format(degrees(sun.alt))
         sun_az = "{:.3f}".format(degrees(sun.az))
 
-        #self.location.date = ephem.Date(self.startTime)
-
         moon = ephem.Moon()
-        moon.compute(self.location)
-        moon_trans = ephem.localtime(self.location.next_transit(ephem.Moon())).time().strftime("%H:%M")
-        moon_atran = ephem.localtime(self.location.next_antitransit(ephem.Moon())).time().strftime("%H:%M")
-        moon_rise = ephem.localtime(self.location.next_rising(ephem.Moon())).time().strftime("%H:%M")
-        moon_set = ephem.localtime(self.location.next_setting(ephem.Moon())).time().strftime("%H:%M")
+        moon.compute(loc)
+        moon_trans = ephem.localtime(loc.next_transit(ephem.Moon())).time().strftime("%H:%M")
+        moon_atran = ephem.localtime(loc.next_antitransit(ephem.Moon())).time().strftime("%H:%M")
+        moon_rise = ephem.localtime(loc.next_rising(ephem.Moon())).time().strftime("%H:%M")
+        moon_set = ephem.localtime(loc.next_setting(ephem.Moon())).time().strftime("%H:%M")
         
-        sun.compute(self.location)
-        sun_trans = ephem.localtime(self.location.next_transit(ephem.Sun())).time().strftime("%H:%M")
-        sun_atran = ephem.localtime(self.location.next_antitransit(ephem.Sun())).time().strftime("%H:%M")
+        sun.compute(loc)
+        sun_trans = ephem.localtime(loc.next_transit(ephem.Sun())).time().strftime("%H:%M")
+        sun_atran = ephem.localtime(loc.next_antitransit(ephem.Sun())).time().strftime("%H:%M")
         
         #age = moon.age()
 
-        os.environ["AS_SUN_ALT"] = str(sun_alt)
-        os.environ["AS_SUN_AZ"] = str(sun_az)
-
-        os.environ["AS_MOON_TRANSIT"] = str(moon_trans)
-        os.environ["AS_MOON_ANTITRANSIT"] = str(moon_atran)
-        os.environ["AS_MOONRISE"] = str(moon_rise)
-        os.environ["AS_MOONSET"] = str(moon_set)
-        #os.environ["AS_MOONAGE"] = str(age)
-
-        os.environ["AS_SUN_NOON"] = str(sun_trans)
-        os.environ["AS_SUN_MIDNIGHT"] = str(sun_atran)
-
+        return {
+            "AS_SUN_ALT": str(sun_alt),
+            "AS_SUN_AZ": str(sun_az),
+            "AS_MOON_TRANSIT": str(moon_trans),
+            "AS_MOON_ANTITRANSIT": str(moon_atran),
+            "AS_MOONRISE": str(moon_rise),
+            "AS_MOONSET": str(moon_set),
+            #"AS_MOONAGE": str(age),
+            "AS_SUN_NOON": str(sun_trans),
+            "AS_SUN_MIDNIGHT": str(sun_atran)
+        }
 
-    def __init__(self, debug, params):
+    def __init__(self, debug, params, image, nowUTC=None):
+        if nowUTC is None:
+            nowUTC = datetime.datetime.utcnow()
+        self.nowTimeUTC = nowUTC
+        self.nowTime = nowUTC.replace(tzinfo=datetime.timezone.utc).astimezone().replace(tzinfo=None)
         self.get_params(debug, params)
-        self.set_size(debug, params)
+        self.set_size(debug, params, image)
         self.set_time(debug, params)
         self.calculations(debug, params)
         if params["draw_elev"] == True:
             self.calSunMoon(params)
 
+class ephemCache():
+    '''
+    Geocentric sun and moon positions (apparent RA/Dec, sun radius, moon distance and
+    phase) every STEP (4 hours), computed with ephem once and interpolated for any time.
+    They do not depend on the observer, so every location and query shares them.
+    '''
+    STEP = 1.0 / 6.0 # days between cached samples
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.first = 0 # index of the first sample, in STEP units since ephem's epoch
+        self.data = np.zeros((7, 0))
+        self.refraction = None
+
+    def _compute(self, n1, n2):
+        sun = ephem.Sun()
+        moon = ephem.Moon()
+        res = np.zeros((7, n2 - n1))
+        for i in range(n2 - n1):
+            d = ephem.Date((n1 + i) * self.STEP)
+            sun.compute(d)
+            moon.compute(d)
+            res[:, i] = (sun.g_ra, sun.g_dec, moon.g_ra, moon.g_dec, moon.earth_distance, moon.moon_phase, sun.radius)
+        return res
+
+    def _refraction(self):
+        # ephem's refraction (default pressure and temperature) against geometric altitude,
+        # tabulated from a sunset at the equator, where the sun goes down vertically
+        if self.refraction is None:
+            loc = ephem.Observer()
+            loc.lat = loc.lon = '0'
+            flat = loc.copy()
+            flat.pressure = 0
+            sun = ephem.Sun()
+            geo = []
+            refr = []
+            for i in range(800):
+                loc.date = flat.date = ephem.Date("2000/3/20 16:00") + i * 15 * ephem.second
+                sun.compute(flat)
+                a = sun.alt
+                sun.compute(loc)
+                geo.append(degrees(a))
+                refr.append(degrees(sun.alt - a))
+            order = np.argsort(geo)
+            self.refraction = (np.array(geo)[order], np.array(refr)[order])
+        return self.refraction
+
+    def positions(self, d):
+        # interpolated rows for ephem dates d (days), see _compute for their order
+        if np.size(d) == 0:
+            return [np.zeros(np.shape(d)) for i in range(self.data.shape[0])]
+        n1 = int(floor(np.min(d) / self.STEP)) - 1
+        n2 = int(ceil(np.max(d) / self.STEP)) + 2
+        with self.lock:
+            last = self.first + self.data.shape[1]
+            if self.data.shape[1] == 0:
+                self.first, self.data = n1, self._compute(n1, n2)
+            else:
+                if n1 < self.first:
+                    self.data = np.hstack((self._compute(n1, self.first), self.data))
+                    self.first = n1
+                if n2 > last:
+                    self.data = np.hstack((self.data, self._compute(last, n2)))
+            data = self.data[:, n1 - self.first:n2 - self.first]
+        grid = np.arange(n1, n2) * self.STEP
+        res = []
+        for i, row in enumerate(data):
+            if i in (0, 2):
+                row = np.unwrap(row) # right ascension wraps at 24h
+            res.append(np.interp(d, grid, row))
+        return res
+
+    def altitudes(self, d, latitude, longitude):
+        # topocentric sun and moon altitudes (degrees) seen from latitude, longitude at ephem dates d
+        sun_ra, sun_dec, moon_ra, moon_dec, moon_dist, moon_phase, sun_radius = self.positions(d)
+        # apparent sidereal time, mean plus the main nutation terms (equation of the equinoxes)
+        days = d + 2415020.0 - 2451545.0
+        node = np.radians(125.04452 - 0.0529538083 * days)
+        sun_l = np.radians(280.4665 + 0.98564736 * days)
+        moon_l = np.radians(218.3165 + 13.17639648 * days)
+        nutation = (-17.20 * np.sin(node) - 1.32 * np.sin(2 * sun_l) - 0.23 * np.sin(2 * moon_l) + 0.21 * np.sin(2 * node)) / 3600.0
+        lst = np.radians(280.46061837 + 360.98564736629 * days + nutation * cos(radians(23.4393)) + longitude)
+        lat = np.radians(latitude)
+
+        def alt(ra, dec):
+            return np.arcsin(np.sin(lat) * np.sin(dec) + np.cos(lat) * np.cos(dec) * np.cos(lst - ra))
+
+        # sun as the light graph sees it (_sunAltHa): upper limb, refracted
+        sun_alt = alt(sun_ra, sun_dec)
+        sun_alt = np.degrees(sun_alt - np.arcsin(ephem.earth_radius / ephem.meters_per_au * np.cos(sun_alt)))
+        with self.lock:
+            geo, refr = self._refraction()
+        sun_alt = sun_alt + np.interp(sun_alt, geo, refr) + np.degrees(sun_radius)
+        moon_alt = alt(moon_ra, moon_dec)
+        # lunar parallax lowers the moon up to one degree from the geocentric position
+        moon_alt = moon_alt - np.arcsin(ephem.earth_radius / (moon_dist * ephem.meters_per_au) * np.cos(moon_alt))
+        return sun_alt, np.degrees(moon_alt), moon_phase
+
+_ephemCache = ephemCache()
+
+def darkness(start, nights, latitude=None, longitude=None, horizon=-18.0, step=300):
+    '''
+    Dark time planning for nights consecutive nights, the first one being the evening of
+    start (a date). Each night runs from local mean noon to the next one, sampled every
+    step seconds. latitude and longitude (degrees) default to the allsky settings.
+    Dark is the sun below horizon (astronomical darkness by default), with the same altitude
+    as the light graph (upper limb, refracted as ephem does), moon free is dark
+    with the moon below the horizon (upper limb and standard refraction, -0.83 degrees).
+    Returns a dict of NumPy arrays, one item per night:
+        night           evening date (datetime64[D])
+        dark_hours      hours of darkness
+        moonfree_hours  hours of darkness with no moon up
+        dark_start      start of darkness, UTC (datetime64[s], NaT if no darkness)
+        dark_end        end of darkness, UTC (datetime64[s], NaT if no darkness)
+        moon_phase      moon illuminated fraction at local mean midnight
+    '''
+    if latitude is None:
+        latitude = s.convertLatLon(s.getSetting("latitude"))
+    if longitude is None:
+        longitude = s.convertLatLon(s.getSetting("longitude"))
+
+    per_night = int(24 * 3600 / step)
+    noon = ephem.Date(datetime.datetime(start.year, start.month, start.day, 12)) - longitude / 360.0
+    night = noon + np.arange(nights)[:, np.newaxis]
+    d = night + (np.arange(per_night)[np.newaxis, :] + 0.5) * step / 86400.0
+
+    sun_alt, moon_alt, moon_phase = _ephemCache.altitudes(d, latitude, longitude)
+    dark = sun_alt < horizon
+
+    # first and last dark samples, the crossing refined between them and their neighbours
+    any_dark = dark.any(axis=1)
+    rows = np.arange(nights)
+    first = np.argmax(dark, axis=1)
+    last = per_night - 1 - np.argmax(dark[:, ::-1], axis=1)
+    prev = np.maximum(first - 1, 0)
+    succ = np.minimum(last + 1, per_night - 1)
+
+    def crossing(i, j):
+        # Illinois regula falsi, all nights at once, between samples i and j of each night
+        a, b = d[rows, i], d[rows, j]
+        fa, fb = sun_alt[rows, i] - horizon, sun_alt[rows, j] - horizon
+        ok = (fa < 0) != (fb < 0)
+        fa, fb = np.where(ok, fa, 1.0), np.where(ok, fb, -1.0)
+        side = np.zeros(nights)
+        for n in range(8):
+            t = a + (b - a) * fa / (fa - fb)
+            ft = _ephemCache.altitudes(t, latitude, longitude)[0] - horizon
+            left = (ft < 0) == (fa < 0)
+            fb = np.where(left & (side == 1), fb / 2.0, fb)
+            fa = np.where(~left & (side == -1), fa / 2.0, fa)
+            a, fa = np.where(left, t, a), np.where(left, ft, fa)
+            b, fb = np.where(left, b, t), np.where(left, fb, ft)
+            side = np.where(left, 1, -1)
+        return a + (b - a) * fa / (fa - fb)
+
+    t1 = np.where(first > 0, crossing(prev, first), night[:, 0])
+    t2 = np.where(last < per_night - 1, crossing(last, succ), night[:, 0] + 1.0)
+    # each sample stands for its step, counted for the part of it inside the refined darkness
+    cell = night + np.arange(per_night)[np.newaxis, :] * step / 86400.0
+    inside = np.clip(np.minimum(cell + step / 86400.0, t2[:, np.newaxis]) - np.maximum(cell, t1[:, np.newaxis]), 0.0, None)
+    inside = np.where(any_dark[:, np.newaxis], inside * 24.0, 0.0)
+
+    epoch = np.datetime64(ephem.Date(0).datetime(), "s")
+    dark_start = epoch + np.round(t1 * 86400.0).astype("timedelta64[s]")
+    dark_end = epoch + np.round(t2 * 86400.0).astype("timedelta64[s]")
+
+    return {
+        "night": np.datetime64(start, "D") + np.arange(nights),
+        "dark_hours": inside.sum(axis=1),
+        "moonfree_hours": (inside * (moon_alt < -0.83)).sum(axis=1),
+        "dark_start": np.where(any_dark, dark_start, np.datetime64("NaT")),
+        "dark_end": np.where(any_dark, dark_end, np.datetime64("NaT")),
+        "moon_phase": moon_phase[:, per_night // 2]
+    }
+
+def render(image, params, nowUTC=None):
+    '''
+    Reentrant entry point: draws the graph for params (plus optional "latitude" and
+    "longitude", in degrees, north and east positive, or allsky format strings such as
+    "51.5N"; allsky settings otherwise) on image and returns the composited image
+    and the exported variables, without touching allsky_shared.image or os.environ.
+    Safe to call from several threads, one image per call.
+    '''
+    drawer = lGraph(params["debug"], params, image, nowUTC)
+    data = drawer.exportData()
+    return drawer.draw(params, image), data
+
+def composite(image, layer):
+    # blend a layer from lGraph.layer on image, in place
+    for y1, x1, color, coverage in layer:
+        roi = image[y1:y1 + color.shape[0], x1:x1 + color.shape[1]]
+        res = roi * (1.0 - coverage) + color
+        if image.dtype.kind in "ui":
+            res = np.clip(np.rint(res), 0, np.iinfo(image.dtype).max)
+        roi[:] = res.astype(image.dtype)
+    return image
+
+class prerender():
+    '''
+    Speculative rendering: after each image the overlay for the next one (now plus the
+    time between the last two calls) is prepared while the camera is exposing, by a helper
+    process that stays in the background (allsky runs modules in a new process per image),
+    and left in allsky tmp. The next call computes the graph as usual and, if every pixel
+    position matches the prepared overlay, only composites it, giving the same image a
+    synchronous render would (within rounding). Otherwise it draws as usual.
+    The helper exits after IDLE seconds without a job. It keeps cv2, numpy and ephem
+    loaded and draws each overlay once more, so total CPU and memory go up: this only
+    shortens the time per image, it does not make the module cheaper.
+    Use one name per camera when several cameras share the tmp dir.
+    '''
+    IDLE = 600 # seconds the helper waits for a job before exiting
+    POLL = 0.1 # seconds between job checks in the helper
+
+    def __init__(self, name="lightgraph"):
+        self.lock = threading.Lock()
+        self.name = name
+
+    def _path(self, suffix):
+        return _tmpPath("{0}_prerender{1}".format(self.name, suffix))
+
+    def _key(self, params, image, drawer):
+        # location resolved by lGraph, so a change in the allsky settings is a miss too
+        return json.dumps([sorted(params.items()), list(image.shape), image.dtype.str, drawer.latitude, drawer.longitude], default=str)
+
+    def _load(self, key, signature):
+        # the prepared layer, if it was made for these settings and draws the same pixels
+        try:
+            with np.load(self._path(".npz")) as f:
+                if str(f["key"]) != key or str(f["signature"]) != signature:
+                    return None
+                top = float(f["top"])
+                return [(int(f["y1_%d" % i]), int(f["x1_%d" % i]), f["color_%d" % i].astype(np.float32),
+                    f["coverage_%d" % i].astype(np.float32) / top) for i in range(int(f["n"]))]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _lastCall(self, nowUTC):
+        # time of the previous call, and remember this one
+        path = self._path(".json")
+        try:
+            with open(path) as f:
+                last = datetime.datetime.strptime(json.load(f)["last"], "%Y-%m-%dT%H:%M:%S.%f")
+        except (OSError, ValueError, KeyError):
+            last = None
+        _writeAside(path, json.dumps({"last": nowUTC.strftime("%Y-%m-%dT%H:%M:%S.%f")}).encode())
+        return last
+
+    def _helperRunning(self):
+        # the helper holds the lock while it runs
+        try:
+            with open(self._path(".lock"), "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        return False
+
+    def _request(self, params, image, whenUTC):
+        # leave the job for the helper, starting it if it is not running
+        job = {
+            "params": params,
+            "shape": list(image.shape),
+            "dtype": image.dtype.str,
+            "when": whenUTC.strftime("%Y-%m-%dT%H:%M:%S.%f")
+        }
+        _writeAside(self._path("_job.json"), json.dumps(job, default=str).encode())
+        if self._helperRunning():
+            return
+        env = dict(os.environ)
+        paths = [os.path.dirname(os.path.abspath(__file__)), os.path.dirname(os.path.abspath(s.__file__))]
+        env["PYTHONPATH"] = os.pathsep.join(paths + [env.get("PYTHONPATH", "")])
+        try:
+            subprocess.Popen([sys.executable, os.path.abspath(__file__), "--prerender", self.name], env=env,
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        except OSError:
+            pass
+
+    def prepare(self, path):
+        # draw the layer described by a job file and leave it in tmp, in the image type
+        with open(path) as f:
+            job = json.load(f)
+        params = job["params"]
+        when = datetime.datetime.strptime(job["when"], "%Y-%m-%dT%H:%M:%S.%f")
+        image = np.empty(job["shape"], np.dtype(job["dtype"])) # only its shape and type are used
+        drawer = lGraph(params["debug"], params, image, when)
+        layer = drawer.layer(params, image)
+        top = np.iinfo(image.dtype).max if image.dtype.kind in "ui" else 1.0
+        arrays = {"key": self._key(params, image, drawer), "signature": drawer.signature(params), "top": top, "n": len(layer)}
+        for i, (y1, x1, color, coverage) in enumerate(layer):
+            coverage = coverage * top
+            if image.dtype.kind in "ui":
+                color = np.clip(np.rint(color), 0, top).astype(image.dtype)
+                coverage = np.clip(np.rint(coverage), 0, top).astype(image.dtype)
+            arrays.update({"y1_%d" % i: y1, "x1_%d" % i: x1, "color_%d" % i: color, "coverage_%d" % i: coverage})
+        buf = io.BytesIO()
+        np.savez_compressed(buf, **arrays)
+        _writeAside(self._path(".npz"), buf.getvalue())
+
+    def serve(self):
+        # helper process: prepare every new job, until IDLE seconds pass without one
+        lock = open(self._path(".lock"), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return # another helper is serving
+        path = self._path("_job.json")
+        done = None
+        idle = time.monotonic()
+        while time.monotonic() - idle < self.IDLE:
+            try:
+                st = os.stat(path)
+                job = (st.st_ino, st.st_mtime_ns)
+            except OSError:
+                job = None
+            if job is not None and job != done:
+                done = job
+                self.prepare(path)
+                idle = time.monotonic()
+            else:
+                time.sleep(self.POLL)
+
+    def render(self, image, params, nowUTC=None):
+        # same as render(), using the prepared overlay when it draws the same pixels
+        if nowUTC is None:
+            nowUTC = datetime.datetime.utcnow()
+        with self.lock:
+            drawer = lGraph(params["debug"], params, image, nowUTC)
+            data = drawer.exportData()
+            layer = self._load(self._key(params, image, drawer), drawer.signature(params))
+            if layer is None:
+                image = drawer.draw(params, image)
+            else:
+                image = composite(image, layer)
+
+            last = self._lastCall(nowUTC)
+            if last is not None and nowUTC > last:
+                self._request(params, image, nowUTC + (nowUTC - last))
+        return image, data
+
+_prerender = prerender()
+
 def lightgraph(params, event):
     s.startModuleDebug("allsky_lightgraph")
 
-    debug = params["debug"]
-    drawer = lGraph(debug, params)
-    drawer.exportData()
-    drawer.draw(params)
+    if params.get("prerender") == True:
+        s.image, data = _prerender.render(s.image, params)
+    else:
+        s.image, data = render(s.image, params)
+    os.environ.update(data)
     result ="Light Graph Complete"
     
     s.log(1, "INFO {0}".format(result))
     return result
 
+if __name__ == "__main__" and len(sys.argv) == 3 and sys.argv[1] == "--prerender":
+    prerender(sys.argv[2]).serve()
@@ -0,0 +1,126 @@
+'''
+dayPartition.py
+
+Companion of dayTlapse.sh.
+Splits a day's image directory into day and night images by sun altitude at
+capture time, using the same twilight event computation as allsky_lightgraph.
+Images are placed with hard links (or renames) inside the same filesystem,
+so nothing is copied. Where hard links are not supported (FAT/exFAT drives)
+--link renames the day images instead.
+Only images named by allsky (image-YYYYMMDDhhmmss) are placed, other files
+are left where they are.
+
+Usage:
+    dayPartition.py [--move] [--angle DEG] SOURCE_DIR DAY_DIR
+
+    SOURCE_DIR  day directory as created by allsky (e.g. images/20231016)
+    DAY_DIR     directory receiving the day images (e.g. images/20231016d)
+    --link      hard link day images into DAY_DIR (default), originals are kept
+                when the filesystem has hard links, otherwise they are moved
+    --move      rename day images into DAY_DIR, if already linked just drop the original
+    --angle     sun altitude splitting day and night, allsky 'angle' setting by default
+'''
+import os
+import sys
+import errno
+import argparse
+import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+if "ALLSKY_SCRIPTS" in os.environ:
+    sys.path.append(os.path.join(os.environ["ALLSKY_SCRIPTS"], "modules"))
+sys.path.append("/opt/allsky/modules")
+
+import allsky_shared as s
+import allsky_lightgraph as lg
+
+IMAGE_EXT = (".jpg", ".jpeg", ".png")
+
+class dayPartition(lg.lGraph):
+
+    def __init__(self, angle):
+        self.latitude = s.convertLatLon(s.getSetting("latitude"))
+        self.longitude = s.convertLatLon(s.getSetting("longitude"))
+        self.HORIZONS = ((angle, ("Dawn", "Dusk")),)
+        self.angle = angle
+        self.nowTimeUTC = datetime.datetime.utcnow()
+        self._setLocation()
+
+    def _captureTime(self, path):
+        # UTC capture time, from allsky's image-YYYYMMDDhhmmss name (local time), None for other names
+        stem = os.path.splitext(os.path.basename(path))[0]
+        try:
+            ts = datetime.datetime.strptime(stem[-14:], "%Y%m%d%H%M%S").timestamp()
+        except ValueError:
+            return None
+        return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).replace(tzinfo=None)
+
+    def split(self, images):
+        # return the day images, walking the sorted capture times through the dawn/dusk events
+        shots = sorted((t, f) for t, f in ((self._captureTime(f), f) for f in images) if t is not None)
+        if not shots:
+            return []
+        t1 = shots[0][0]
+        t2 = shots[-1][0]
+        events = sorted(e for e in self._sunEvents(t1, t2) if e[1] in ("Dawn", "Dusk"))
+        day = self._sunAltHa(lg.ephem.Sun(), t1)[0] > self.angle
+
+        res = []
+        for t, f in shots:
+            while events and events[0][0] <= t:
+                day = events[0][1] == "Dawn"
+                events = events[1:]
+            if day:
+                res = res + [f]
+        return res
+
+def _place(src, dst, move):
+    if move:
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            os.unlink(src)
+        else:
+            os.rename(src, dst)
+    elif not os.path.exists(dst):
+        try:
+            os.link(src, dst)
+        except OSError as e:
+            # no hard links on this filesystem (FAT/exFAT), move it instead
+            if e.errno not in (errno.EPERM, errno.ENOTSUP, errno.EOPNOTSUPP):
+                raise
+            os.rename(src, dst)
+
+def main():
+    parser = argparse.ArgumentParser(description="Split a day's images into day and night by sun altitude")
+    parser.add_argument("source")
+    parser.add_argument("dest")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--link", dest="move", action="store_false")
+    mode.add_argument("--move", dest="move", action="store_true")
+    parser.add_argument("--angle", type=float, default=None)
+    parser.set_defaults(move=False)
+    args = parser.parse_args()
+
+    angle = args.angle
+    if angle is None:
+        angle = float(s.getSetting("angle") or -6.0)
+
+    images = [os.path.join(args.source, f) for f in os.listdir(args.source) if f.lower().endswith(IMAGE_EXT)]
+    day = dayPartition(angle).split(images)
+
+    os.makedirs(os.path.join(args.dest, "thumbnails"), exist_ok=True)
+    try:
+        for f in day:
+            name = os.path.basename(f)
+            _place(f, os.path.join(args.dest, name), args.move)
+            thumb = os.path.join(args.source, "thumbnails", name)
+            if os.path.exists(thumb):
+                _place(thumb, os.path.join(args.dest, "thumbnails", name), args.move)
+    except OSError as e:
+        print("dayPartition.py: ERROR: {0}".format(e), file=sys.stderr)
+        return 2
+
+    print("dayPartition.py: {0} day images of {1} {2}".format(len(day), len(images), "moved" if args.move else "linked"))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
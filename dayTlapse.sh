@@ -1,6 +1,7 @@
 #!/bin/bash
 
 ME="$(basename "${BASH_ARGV0}")"
+ME_DIR="$(dirname "$(realpath "${BASH_ARGV0}")")"
 
 # Modifications in /allsky/html/allsky/functions.php
 # line 339... added
@@ -58,12 +59,12 @@ if [[ ${TIMELAPSE} == "true" ]]; then
         exit 2
     fi
 
-    # copy images up to now (day ones) to temp dir
-    echo -e "${ME}: ===== Copying Day images for ${TODAY}"
-    cp -r ${TODAY_DIR}/. ${TODAY_DAY_DIR}
+    # hard link the day images (by sun altitude) into the day dir, nothing is copied
+    echo -e "${ME}: ===== Linking Day images for ${TODAY}"
+    python3 "${ME_DIR}/dayPartition.py" --link "${TODAY_DIR}" "${TODAY_DAY_DIR}"
     RET=$?
     if [[ ${RET} != 0 ]]; then
-        echo -e "${ME}: ${RED}ERROR: Could not copy images"
+        echo -e "${ME}: ${RED}ERROR: Could not link images"
         exit 2
     fi
 
@@ -84,8 +85,8 @@ if [[ ${TIMELAPSE} == "true" ]]; then
         # remove day images (TBD)
         # leave images there if daily timelapse is activated and you also want a full timelapse
         # instead of the 'normal' nightly timelapse, that you will get if images so far today are removed
-        # only remove contents, there's the night left
-        rm -r ${TODAY_DIR}/*
+        # only the day links are dropped, night images stay for the nightly timelapse
+        python3 "${ME_DIR}/dayPartition.py" --move "${TODAY_DIR}" "${TODAY_DAY_DIR}"
     fi  
 
 